@@ -23,42 +23,47 @@ from .constants import CommandStatus, CameraStatus
 
 from .sdkprocess import enable_read_mode_functions
 READOUT_MODES = list(enable_read_mode_functions.keys())
+_READOUT_MODES_USAGE = '|'.join(READOUT_MODES)
+_READOUT_MODES_COMPLETION = ' '.join(READOUT_MODES)
+
+_STATUS_TEMPLATE = '\n'.join([
+    '   Temperature is [b][{temperature_color}]{cooler_temperature:.0f}\u00B0C[/{temperature_color}][/b] '
+    '({temperature_status})',
+    '   Output Window is [b]\\[{w[0]}:{w[1]},{w[2]}:{w[3]}] px[/b]',
+    '   Binning is [b]{binning} x {binning} px[/b]',
+    '   Exposure time is [b]{exposure_time:.2f} s[/b]',
+    '   Readout mode is [b]{read_mode}[/b]'
+])
+
 
 def run_client_command(config_path, usage_prefix, args):
     """Prints the message associated with a status code and returns the code"""
-    config = Config(config_path)
-    commands = {
-        'bin': set_binning,
-        'exposure': set_exposure,
-        'start': start,
-        'status': status,
-        'stop': stop,
-        'window': set_window,
-        'cooling': set_cooling,
-        'mode': set_mode,
-        'init': initialize,
-        'kill': shutdown
-    }
-
-    if len(args) == 0 or (args[0] not in commands and args[0] != 'completion'):
-        return print_usage(usage_prefix)
-
-    if args[0] == 'completion':
+    # Shell completion doesn't need the config, so skip loading it
+    if args and args[0] == 'completion':
         if 'start' in args[-2:]:
             print('continuous')
         elif 'cooling' in args[-2:]:
             print('enable disable')
         elif 'mode' in args[-2:]:
-            print(' '.join(READOUT_MODES))
+            print(_READOUT_MODES_COMPLETION)
         elif len(args) < 3:
-            print(' '.join(commands))
+            print(_COMMAND_NAMES)
         return 0
 
+    if len(args) == 0 or args[0] not in _COMMANDS:
+        return print_usage(usage_prefix)
+
+    config = Config(config_path)
+
     try:
-        ret = commands[args[0]](config, usage_prefix, args[1:])
+        # Initialization can take more than 5 sec, so bump timeout to 20 seconds.
+        # The connection is only opened if the command needs to talk to the daemon
+        with (config.daemon.connect(20) if args[0] == 'init' else config.daemon.connect()) as camd:
+            ret = _COMMANDS[args[0]](camd, usage_prefix, args[1:])
     except KeyboardInterrupt:
         # ctrl-c terminates the running command
-        ret = stop(config, args)
+        with config.daemon.connect() as camd:
+            ret = stop(camd)
 
         # Report successful stop
         if ret == 0:
@@ -73,27 +78,27 @@ def run_client_command(config_path, usage_prefix, args):
     return ret
 
 
-def status(config, *_):
+def status(camd, *_):
     """Reports the current camera status"""
-    with config.daemon.connect() as camd:
-        data = camd.report_status()
+    data = camd.report_status()
 
     state_desc = CameraStatus.label(data['state'], formatting=True)
     if data['state'] == CameraStatus.Acquiring:
         state_desc += f' ([b]{data["exposure_progress"]:.1f} / {data["exposure_time"]:.1f}s[/b])'
 
     # Camera is disabled
-    print(f'   Camera is {state_desc}')
     if data['state'] == CameraStatus.Disabled:
+        print(f'   Camera is {state_desc}')
         return 0
 
+    lines = [f'   Camera is {state_desc}']
     if data['state'] > CameraStatus.Idle:
         if data['sequence_frame_limit'] > 0:
             count = data['sequence_frame_count'] + 1
             limit = data['sequence_frame_limit']
-            print(f'   Acquiring frame [b]{count} / {limit}[/b]')
+            lines.append(f'   Acquiring frame [b]{count} / {limit}[/b]')
         else:
-            print(f'   Acquiring [b]UNTIL STOPPED[/b]')
+            lines.append('   Acquiring [b]UNTIL STOPPED[/b]')
 
     if data['temperature_locked']:
         temperature_status = '[b][green]LOCKED[/green][/b]'
@@ -105,48 +110,45 @@ def status(config, *_):
         temperature_status = f'[b]LOCKING ON {data["cooler_setpoint"]:.0f}\u00B0C[/b]'
         temperature_color = 'red'
 
-    print(f'   Temperature is [b][{temperature_color}]{data["cooler_temperature"]:.0f}\u00B0C[/{temperature_color}][/b] ({temperature_status})')
+    lines.append(_STATUS_TEMPLATE.format(
+        temperature_status=temperature_status,
+        temperature_color=temperature_color,
+        w=[x + 1 for x in data['window']],
+        **data))
 
-    w = [x + 1 for x in data['window']]
-    print(f'   Output Window is [b]\[{w[0]}:{w[1]},{w[2]}:{w[3]}] px[/b]')
-    print(f'   Binning is [b]{data["binning"]} x {data["binning"]} px[/b]')
-    print(f'   Exposure time is [b]{data["exposure_time"]:.2f} s[/b]')
-    print(f'   Readout mode is [b]{data["read_mode"]}[/b]')
+    print('\n'.join(lines))
     return 0
 
 
-def set_exposure(config, usage_prefix, args):
+def set_exposure(camd, usage_prefix, args):
     """Set the camera exposure time"""
     if len(args) == 1:
         exposure = float(args[0])
-        with config.daemon.connect() as camd:
-            return camd.set_exposure(exposure)
+        return camd.set_exposure(exposure)
     print(f'usage: {usage_prefix} exposure <seconds>')
     return -1
 
 
-def set_cooling(config, usage_prefix, args):
+def set_cooling(camd, usage_prefix, args):
     """Set the camera cooling mode"""
     if len(args) == 1 and (args[0] == 'enable' or args[0] == 'disable'):
         enabled = args[0] == 'enable'
-        with config.daemon.connect() as camd:
-            return camd.set_cooling(enabled)
+        return camd.set_cooling(enabled)
     print(f'usage: {usage_prefix} cooling (enable|disable)')
     return -1
 
 
-def set_binning(config, usage_prefix, args):
+def set_binning(camd, usage_prefix, args):
     """Set the camera binning"""
     if len(args) == 1:
         # Assume square pixels
         binning = int(args[0])
-        with config.daemon.connect() as camd:
-            return camd.set_binning(binning, binning)
+        return camd.set_binning(binning, binning)
     print(f'usage: {usage_prefix} bin <pixel size>')
     return -1
 
 
-def set_window(config, usage_prefix, args):
+def set_window(camd, usage_prefix, args):
     """Set the camera readout window"""
     window = None
     if len(args) == 4:
@@ -158,23 +160,21 @@ def set_window(config, usage_prefix, args):
         ]
 
     if window or (len(args) == 1 and args[0] == 'default'):
-        with config.daemon.connect() as camd:
-            return camd.set_window(window)
+        return camd.set_window(window)
 
     print(f'usage: {usage_prefix} window (<x1> <x2> <y1> <y2>|default)')
     return -1
 
 
-def set_mode(config, usage_prefix, args):
+def set_mode(camd, usage_prefix, args):
     """Set the camera readout mode"""
     if len(args) == 1 and args[0] in READOUT_MODES:
-        with config.daemon.connect() as camd:
-            return camd.set_mode(args[0])
-    print(f'usage: {usage_prefix} mode ({"|".join(READOUT_MODES)})')
+        return camd.set_mode(args[0])
+    print(f'usage: {usage_prefix} mode ({_READOUT_MODES_USAGE})')
     return -1
 
 
-def start(config, usage_prefix, args):
+def start(camd, usage_prefix, args):
     """Starts an exposure sequence"""
     if len(args) == 1:
         try:
@@ -184,30 +184,84 @@ def start(config, usage_prefix, args):
             return -1
 
         if args[0] == 'continuous' or count > 0:
-            with config.daemon.connect() as camd:
-                return camd.start_sequence(count)
+            return camd.start_sequence(count)
 
     print(f'usage: {usage_prefix} start (continuous|<count>)')
     return -1
 
 
-def stop(config, *_):
+def _compound_call(command, value):
+    """Parses a single compound setting into a (method, *args) daemon call, or None if it is invalid"""
+    if command == 'exposure':
+        return 'set_exposure', float(value)
+    if command == 'bin':
+        # Assume square pixels
+        return 'set_binning', int(value)
+    if command == 'cooling' and value in ['enable', 'disable']:
+        return 'set_cooling', value == 'enable'
+    if command == 'mode' and value in READOUT_MODES:
+        return 'set_mode', value
+    if command == 'start' and (value == 'continuous' or int(value) > 0):
+        return 'start_sequence', 0 if value == 'continuous' else int(value)
+    return None
+
+
+def compound(camd, usage_prefix, args):
+    """
+    Applies several settings in a single round-trip and optionally starts an exposure sequence.
+    Every setting is attempted even if an earlier one fails, but the sequence is only started
+    (with a second request) if all of the settings succeeded.
+    """
+    try:
+        calls = [_compound_call(command, value) for command, value in zip(args[::2], args[1::2])]
+    except ValueError:
+        calls = []
+
+    valid = calls and len(args) % 2 == 0 and None not in calls
+
+    # start must be the final token
+    start_call = None
+    if valid and calls[-1][0] == 'start_sequence':
+        start_call = calls.pop()
+
+    if valid and all(method != 'start_sequence' for method, *_ in calls):
+        # Report the first failed setting, if any
+        results = _batched(camd, *calls) if calls else []
+        for (method, *_), ret in zip(calls, results):
+            if ret != CommandStatus.Succeeded:
+                print(f'{method} failed' + (': sequence not started' if start_call is not None else ''))
+                return ret
+
+        if start_call is not None:
+            return camd.start_sequence(start_call[1])
+        return CommandStatus.Succeeded
+
+    print(f'usage: {usage_prefix} compound (exposure <seconds>|bin <pixel size>|cooling (enable|disable)|'
+          f'mode ({_READOUT_MODES_USAGE})) ... [start (continuous|<count>)]')
+    return -1
+
+
+def _batched(camd, *calls):
+    """Invokes a sequence of (method, *args) daemon calls in a single round-trip and returns their results"""
+    batch = Pyro4.batch(camd)
+    for method, *args in calls:
+        getattr(batch, method)(*args)
+    return list(batch())
+
+
+def stop(camd, *_):
     """Stops any active camera exposures"""
-    with config.daemon.connect() as camd:
-        return camd.stop_sequence()
+    return camd.stop_sequence()
 
 
-def initialize(config, *_):
+def initialize(camd, *_):
     """Enables the camera driver"""
-    # Initialization can take more than 5 sec, so bump timeout to 20 seconds.
-    with config.daemon.connect(20) as camd:
-        return camd.initialize()
+    return camd.initialize()
 
 
-def shutdown(config, *_):
+def shutdown(camd, *_):
     """Disables the camera drivers"""
-    with config.daemon.connect() as camd:
-        return camd.shutdown()
+    return camd.shutdown()
 
 
 def print_usage(usage_prefix):
@@ -222,6 +276,7 @@ def print_usage(usage_prefix):
     print('   mode         set the readout mode')
     print('   window       set readout window')
     print('   start        start an exposure sequence')
+    print('   compound     apply several of the above settings (and start) in one request')
     print()
     print('engineering commands:')
     print('   init         initialize the camera driver')
@@ -229,3 +284,20 @@ def print_usage(usage_prefix):
     print()
 
     return 0
+
+
+_COMMANDS = {
+    'bin': set_binning,
+    'exposure': set_exposure,
+    'start': start,
+    'compound': compound,
+    'status': status,
+    'stop': stop,
+    'window': set_window,
+    'cooling': set_cooling,
+    'mode': set_mode,
+    'init': initialize,
+    'kill': shutdown
+}
+
+_COMMAND_NAMES = ' '.join(_COMMANDS)
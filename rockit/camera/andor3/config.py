@@ -98,6 +98,10 @@ CONFIG_SCHEMA = {
         },
         'expcount_path': {
             'type': 'string',
+        },
+        'acquisition_cpu': {
+            'type': 'integer',
+            'min': 0
         }
     }
 }
@@ -134,3 +138,4 @@ class Config:
         self.header_card_capacity = config_json['header_card_capacity']
         self.temperature_setpoint = config_json['temperature_setpoint']
         self.temperature_query_delay = config_json['temperature_query_delay']
+        self.acquisition_cpu = config_json.get('acquisition_cpu', None)
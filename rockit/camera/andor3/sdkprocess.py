@@ -24,9 +24,14 @@
 # pylint: disable=too-many-instance-attributes
 # pylint: disable=bare-except
 
-from ctypes import c_uint8
+import copy
+from ctypes import addressof, c_int, c_size_t, c_void_p, CDLL, get_errno
 import json
+import mmap
+import os
 import pathlib
+import queue
+import struct
 import sys
 import threading
 import time
@@ -34,9 +39,21 @@ import traceback
 import numpy as np
 import pyAndorSDK3
 from astropy.time import Time
-import astropy.units as u
 from rockit.common import log
 from .constants import CommandStatus, CameraStatus
+from .outputprocess import FrameMetadata, FRAME_MESSAGE, FRAME_METADATA_BYTES
+
+# Responses sent back to camd over the command pipe are packed instead of pickled
+# Most commands reply with a single CommandStatus value, and status replies have a fixed layout
+# followed by the (variable length) read mode name
+COMMAND_RESPONSE = struct.Struct('<B')
+STATUS_RESPONSE = struct.Struct('<B??dddd4iiqq')
+
+# Error code raised by wait_buffer when no frame arrives before the timeout (atcore.h)
+AT_ERR_TIMEDOUT = 13
+
+# Temperature status strings are interned so they can be compared by identity
+TEMPERATURE_STABILISED = sys.intern('STABILISED')
 
 
 def enable_read_mode_hdr(cam):
@@ -66,6 +83,12 @@ read_mode_encoding = {
     'ffr': 'MONO12',
 }
 
+# Largest pixel value that can be produced by each pixel encoding
+encoding_max_value = {
+    'MONO12': 4095,
+    'MONO16': 65535,
+}
+
 try:
     from .internal import enable_internal_read_modes
     enable_internal_read_modes()
@@ -73,11 +96,79 @@ except:
     pass
 
 
+def encode_sdk_response(response):
+    """Packs a CommandStatus value or report_status dictionary for sending to camd"""
+    if not isinstance(response, dict):
+        return COMMAND_RESPONSE.pack(response)
+
+    return STATUS_RESPONSE.pack(
+        response['state'],
+        response['cooler_enabled'],
+        response['temperature_locked'],
+        response['cooler_temperature'],
+        response['cooler_setpoint'],
+        response['exposure_time'],
+        response['exposure_progress'],
+        *response['window'],
+        response['binning'],
+        response['sequence_frame_limit'],
+        response['sequence_frame_count']) + response['read_mode'].encode('ascii')
+
+
+def decode_sdk_response(data):
+    """Unpacks a response created by encode_sdk_response"""
+    if len(data) == COMMAND_RESPONSE.size:
+        return COMMAND_RESPONSE.unpack(data)[0]
+
+    values = STATUS_RESPONSE.unpack_from(data)
+    return {
+        'state': values[0],
+        'cooler_enabled': values[1],
+        'cooler_temperature': values[3],
+        'cooler_setpoint': values[4],
+        'temperature_locked': values[2],  # used by opsd
+        'exposure_time': values[5],
+        'exposure_progress': values[6],
+        'window': values[7:11],
+        'binning': values[11],
+        'read_mode': data[STATUS_RESPONSE.size:].decode('ascii'),
+        'sequence_frame_limit': values[12],
+        'sequence_frame_count': values[13],
+    }
+
+
+def prefault_framebuffer(framebuffer):
+    """
+    Populate the page tables for the shared framebuffer (and lock it into RAM and
+    request huge pages where permitted) so that the acquisition loop doesn't take
+    page faults the first time each frame buffer is used.
+    """
+    # madvise requires a page-aligned start address
+    address = addressof(framebuffer)
+    start = address - address % mmap.PAGESIZE
+    length = address + len(framebuffer) - start
+
+    libc = CDLL(None, use_errno=True)
+    libc.madvise.argtypes = [c_void_p, c_size_t, c_int]
+    libc.mlock.argtypes = [c_void_p, c_size_t]
+
+    if hasattr(mmap, 'MADV_HUGEPAGE') and libc.madvise(start, length, mmap.MADV_HUGEPAGE) != 0:
+        print('Failed to enable huge pages for framebuffer:', os.strerror(get_errno()))
+
+    # Touch one byte per page
+    pages = np.frombuffer(framebuffer, dtype=np.uint8)[::mmap.PAGESIZE]
+    pages.sum()
+
+    if libc.mlock(start, length) != 0:
+        print('Failed to lock framebuffer into memory:', os.strerror(get_errno()))
+
+
 class SDKInterface:
-    def __init__(self, config, processing_queue, processing_framebuffer, processing_framebuffer_offsets,
-                 processing_stop_signal):
+    def __init__(self, config, processing_queue, processing_sequence_queues,
+                 processing_framebuffer, processing_framebuffer_offsets, processing_stop_signal):
         self._config = config
         self._status_condition = threading.Condition()
+        self._status_shutdown = False
         self._command_lock = threading.Lock()
 
         self._sdk = pyAndorSDK3.AndorSDK3()
@@ -92,13 +183,15 @@ class SDKInterface:
 
         self._temperature = 0
         self._temperature_status = None
+        self._temperature_status_bytes = b''
         self._temperature_locked = False
         self._cooler_enabled = False
         self._target_temperature = config.temperature_setpoint
 
         # Crop output data to detector coordinates
-        self._window_region = [0, 0, 0, 0]
-        self._image_region = [0, 0, 0, 0]
+        # Regions are stored as tuples so they can be shared by reference with the output processes
+        self._window_region = (0, 0, 0, 0)
+        self._image_region = (0, 0, 0, 0)
         self._binning = config.binning
 
         self._exposure_time = 1
@@ -111,8 +204,8 @@ class SDKInterface:
         # Number of frames acquired this sequence
         self._sequence_frame_count = 0
 
-        # Time that the latest frame in the exposure was started
-        self._sequence_exposure_start_time = Time.now()
+        # Monotonic clock time (in ns) that the latest frame in the exposure was started
+        self._sequence_exposure_start_ns = None
 
         # Information for building the output filename
         self._output_directory = pathlib.Path(config.output_path)
@@ -129,6 +222,14 @@ class SDKInterface:
             self._exposure_count = 0
             self._exposure_count_reference = Time.now().strftime('%Y-%m-%d')
 
+        # Counters are saved by a single long-lived thread so that writes are always ordered
+        # and it doesn't inherit the CPU affinity and scheduling priority of the acquisition thread
+        self._counter_condition = threading.Condition()
+        self._counter_pending = None
+        self._counter_shutdown = False
+        self._counter_thread = threading.Thread(target=self.__save_counters, daemon=True)
+        self._counter_thread.start()
+
         # Thread that runs the exposure sequence
         # Initialized by start() method
         self._acquisition_thread = None
@@ -139,6 +240,9 @@ class SDKInterface:
 
         # Subprocess for processing acquired frames
         self._processing_queue = processing_queue
+
+        # Per-worker queues for sending sequence-invariant data once at the start of each sequence
+        self._processing_sequence_queues = processing_sequence_queues
         self._processing_stop_signal = processing_stop_signal
 
         # A large block of shared memory for sending frame data to the processing workers
@@ -149,8 +253,36 @@ class SDKInterface:
         # frame buffer, and pushed back on as processing is complete
         self._processing_framebuffer_offsets = processing_framebuffer_offsets
 
+        # Views into the framebuffer that are queued with the SDK
+        # These are created on the first sequence and reused until the frame size changes
+        self._buffers = []
+        self._buffer_metadata = []
+        self._buffer_indices = {}
+        self._buffer_frame_size = 0
+
+        # Fault in the framebuffer pages before the first exposure sequence
+        threading.Thread(target=prefault_framebuffer, args=(processing_framebuffer,), daemon=True).start()
+
+        # Reused by report_status, which is called at a high rate by opsd
+        # This is safe because the dictionary is packed by the command loop before the next call
+        self._status = {
+            'state': CameraStatus.Idle,
+            'cooler_enabled': False,
+            'cooler_temperature': 0,
+            'cooler_setpoint': float(self._config.temperature_setpoint),
+            'temperature_locked': False,
+            'exposure_time': 0,
+            'exposure_progress': 0,
+            'window': None,
+            'binning': None,
+            'read_mode': None,
+            'sequence_frame_limit': 0,
+            'sequence_frame_count': 0,
+        }
+
         # Thread for polling camera status
-        threading.Thread(target=self.__poll_camera_status, daemon=True).start()
+        self._status_thread = threading.Thread(target=self.__poll_camera_status, daemon=True)
+        self._status_thread.start()
 
     @property
     def is_acquiring(self):
@@ -158,26 +290,69 @@ class SDKInterface:
 
     def __poll_camera_status(self):
         """Background thread that polls the camera status"""
-        while True:
+        fail_count = 0
+        while not self._status_shutdown:
             # Take a copy to avoid race conditions with camera shutdown
             cam = self._cam
             if cam is not None:
                 try:
                     # Query temperature status
                     self._temperature = cam.SensorTemperature
-                    self._temperature_status = cam.TemperatureStatus.upper()
-                    self._temperature_locked = self._temperature_status == 'STABILISED'
+                    self.__update_temperature_status(cam.TemperatureStatus)
                     self._cooler_enabled = cam.SensorCooling
+                    fail_count = 0
                 except Exception as e:
+                    # Back off exponentially (up to 64x the normal delay) while the camera keeps failing
+                    fail_count = min(fail_count + 1, 6)
                     print('Failed to query temperature with error', e)
 
-            time.sleep(self._config.temperature_query_delay)
+            # Sleep until the next poll, or wake immediately if shutdown() is called
+            with self._status_condition:
+                self._status_condition.wait_for(lambda: self._status_shutdown,
+                                                timeout=self._config.temperature_query_delay * (1 << fail_count))
+
+    def __update_temperature_status(self, status):
+        """Caches the normalized temperature status reported by the camera"""
+        status = sys.intern(status.upper()) if status else None
+        if status is not self._temperature_status:
+            self._temperature_status_bytes = status.encode('ascii') if status else b''
+            self._temperature_status = status
+        self._temperature_locked = status is TEMPERATURE_STABILISED
+
+    def __prepare_buffers(self, frame_size):
+        """Creates the metadata and frame views into the shared framebuffer for a given frame size"""
+        # Each slot holds the per-frame metadata followed by the frame data
+        offset = 0
+        slot_size = FRAME_METADATA_BYTES + frame_size
+        buffers = []
+        metadata = []
+        while offset + slot_size <= len(self._processing_framebuffer):
+            metadata.append(FrameMetadata.from_buffer(self._processing_framebuffer, offset))
+            buffers.append(np.frombuffer(self._processing_framebuffer, dtype=np.uint8,
+                                         count=frame_size, offset=offset + FRAME_METADATA_BYTES))
+            offset += slot_size
+
+        self._buffers = buffers
+        self._buffer_metadata = metadata
+
+        # Map buffer identity to index to find which buffer each acquisition was written into
+        self._buffer_indices = {id(buffer): i for i, buffer in enumerate(buffers)}
+        self._buffer_frame_size = frame_size
 
     def __run_exposure_sequence(self, quiet):
         """Worker thread that acquires frames and their times.
            Tagged frames are pushed to the acquisition queue
            for further processing on another thread"""
         processing = 0
+
+        # Reduce scheduling jitter between frames by keeping the acquisition thread on its own core
+        if self._config.acquisition_cpu is not None:
+            try:
+                os.sched_setaffinity(0, {self._config.acquisition_cpu})
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(40))
+            except OSError as e:
+                print('Failed to set acquisition thread affinity or priority with error', e)
+
         try:
             self._cam.ExposureTime = max(self._cam.min_ExposureTime, float(self._exposure_time))
             self._cam.CycleMode = 'Continuous'
@@ -185,93 +360,145 @@ class SDKInterface:
             self._cam.MetadataEnable = True
             self._cam.MetadataTimestamp = True
 
+            # Per-frame times are measured using the (much cheaper) monotonic clock
+            # and converted to absolute times relative to reference_time by the output process
             reference_time = Time.now()
+            reference_monotonic_ns = time.monotonic_ns()
             self._cam.TimestampClockReset()
             tick_frequency = self._cam.TimestampClockFrequency
             exposure = self._cam.ExposureTime
             frameperiod = 1.0 / self._cam.FrameRate
             rowperiod = self._cam.RowReadTime
 
+            # Skip cropping in the output process when reading out the full sensor
+            is_full_window = self._window_region == (0, self._readout_width - 1, 0, self._readout_height - 1)
+
+            # Binned frames can be safely stored as 16-bit if the binned sum can never overflow
+            encoding = read_mode_encoding[self._read_mode]
+            max_value = encoding_max_value.get(encoding, None)
+            bin_dtype_hint = None
+            if max_value is not None and self._binning ** 2 * max_value <= 0xFFFF:
+                bin_dtype_hint = 'uint16'
+
             # Prepare the framebuffer offsets
             if not self._processing_framebuffer_offsets.empty():
                 log.error(self._config.log_name, 'Frame buffer offsets queue is not empty!')
                 return
 
-            offset = 0
+            # The framebuffer views only need to be rebuilt if the frame size has changed
             frame_size = self._cam.ImageSizeBytes
-            buffers = []
-            while offset + frame_size <= len(self._processing_framebuffer):
-                cdata = (c_uint8 * frame_size).from_buffer(self._processing_framebuffer, offset)
-                buffer = np.ctypeslib.as_array(cdata)
+            if frame_size != self._buffer_frame_size:
+                self.__prepare_buffers(frame_size)
+
+            buffers = self._buffers
+            metadata = self._buffer_metadata
+            buffer_indices = self._buffer_indices
+            for buffer in buffers:
                 self._cam.queue(buffer, frame_size)
-                buffers.append(buffer)
-                offset += frame_size
+
+            # Send the sequence-invariant data to every worker before the first frame.
+            # The monotonic clock gives a unique id even if the SDK process is restarted
+            sequence_id = time.monotonic_ns()
+
+            # The SDK doesn't expose the config used to decode frames, so take a private
+            # snapshot of it that can't change while the queue feeder thread is pickling it
+            # pylint: disable=protected-access
+            acquisition_config = copy.copy(self._cam._Camera__current_config)
+            # pylint: enable=protected-access
+
+            sequence = {
+                'sequence_id': sequence_id,
+                'acquisition_config': acquisition_config,
+                'acquisition_frame_size': frame_size,
+                'reference_time': reference_time,
+                'reference_monotonic_ns': reference_monotonic_ns,
+                'tick_frequency': tick_frequency,
+                'requested_exposure': self._exposure_time,
+                'exposure': exposure,
+                'frameperiod': frameperiod,
+                'rowperiod': rowperiod,
+                'read_mode': self._read_mode.upper(),
+                'read_mode_comment': read_mode_comments[self._read_mode],
+                'encoding': encoding,
+                'sdk_version': self._sdk_version,
+                'firmware_version': self._camera_firmware_version,
+                'image_region': self._image_region,
+                'window_region': self._window_region,
+                'is_full_window': is_full_window,
+                'binning': self._binning,
+                'bin_dtype_hint': bin_dtype_hint,
+                'filter': self._config.filter,
+                'exposure_count_reference': self._exposure_count_reference,
+                'cooler_setpoint': float(self._config.temperature_setpoint)
+            }
+
+            for sequence_queue in self._processing_sequence_queues:
+                sequence_queue.put(sequence)
+
+            wait_timeout_ms = int(self._exposure_time * 1000) + 5000
+            completed_offsets = []
 
             self._cam.AcquisitionStart()
             while not self._stop_acquisition and not self._processing_stop_signal.value:
-                while not self._processing_framebuffer_offsets.empty():
-                    processing -= 1
-                    offset = self._processing_framebuffer_offsets.get(block=False)
+                # Collect all buffers that have finished processing then requeue them together
+                while True:
+                    try:
+                        completed_offsets.append(self._processing_framebuffer_offsets.get_nowait())
+                    except queue.Empty:
+                        break
+
+                for offset in completed_offsets:
                     self._cam.queue(buffers[offset], frame_size)
+                processing -= len(completed_offsets)
+                completed_offsets.clear()
 
-                self._sequence_exposure_start_time = Time.now()
-                acq = self._cam.wait_buffer(int(self._exposure_time * 1000) + 5000)
-                read_end_time = Time.now()
+                self._sequence_exposure_start_ns = time.monotonic_ns()
+                acq = self._cam.wait_buffer(wait_timeout_ms)
+                while acq is not None:
+                    read_end_ns = time.monotonic_ns()
 
-                buffer_index = -1
-                for i, buffer in enumerate(buffers):
                     # pylint: disable=protected-access
-                    if acq._np_data is buffer:
-                        buffer_index = i
-                        break
+                    buffer_index = buffer_indices.get(id(acq._np_data))
                     # pylint: enable=protected-access
 
-                processing += 1
-                self._processing_queue.put({
-                    'acquisition_buffer_index': buffer_index,
-                    'acquisition_frame_size': frame_size,
-                    # pylint: disable=protected-access
-                    'acquisition_config': self._cam._Camera__current_config,
-                    # pylint: enable=protected-access
-                    'reference_time': reference_time,
-                    'tick_frequency': tick_frequency,
-                    'requested_exposure': self._exposure_time,
-                    'exposure': exposure,
-                    'frameperiod': frameperiod,
-                    'rowperiod': rowperiod,
-                    'read_mode': self._read_mode.upper(),
-                    'read_mode_comment': read_mode_comments[self._read_mode],
-                    'encoding': read_mode_encoding[self._read_mode],
-                    'read_end_time': read_end_time,
-                    'sdk_version': self._sdk_version,
-                    'firmware_version': self._camera_firmware_version,
-                    'image_region': self._image_region,
-                    'window_region': self._window_region,
-                    'binning': self._binning,
-                    'filter': self._config.filter,
-                    'exposure_count': self._exposure_count,
-                    'exposure_count_reference': self._exposure_count_reference,
-                    'cooler_temperature': self._temperature,
-                    'cooler_setpoint': float(self._config.temperature_setpoint),
-                    'cooler_status': self._temperature_status
-                })
-
-                self._exposure_count += 1
-                self._sequence_frame_count += 1
-
-                # Continue exposure sequence?
-                if 0 < self._sequence_frame_limit <= self._sequence_frame_count:
-                    self._stop_acquisition = True
+                    if buffer_index is None:
+                        # Never write metadata into a slot that a worker may be processing
+                        log.error(self._config.log_name, 'Discarding frame from unknown acquisition buffer')
+                    else:
+                        frame_metadata = metadata[buffer_index]
+                        frame_metadata.exposure_count = self._exposure_count
+                        frame_metadata.read_end_ns = read_end_ns
+                        frame_metadata.cooler_temperature = self._temperature
+                        frame_metadata.cooler_status = self._temperature_status_bytes
+
+                        processing += 1
+                        self._processing_queue.put(FRAME_MESSAGE.pack(sequence_id, buffer_index))
+
+                        self._exposure_count += 1
+                        self._sequence_frame_count += 1
+
+                        # Continue exposure sequence?
+                        if 0 < self._sequence_frame_limit <= self._sequence_frame_count:
+                            self._stop_acquisition = True
+                            break
+
+                    # Dispatch any other frames that have already arrived before blocking again.
+                    # The SDK raises a timeout error once there are none left
+                    try:
+                        acq = self._cam.wait_buffer(0)
+                    except pyAndorSDK3.ATCoreException as e:
+                        code = getattr(e, 'code', e.args[0] if e.args else None)
+                        if code != AT_ERR_TIMEDOUT:
+                            raise
+                        acq = None
         finally:
             self._cam.AcquisitionStop()
             self._cam.flush()
 
-            # Save updated counts to disk
-            with open(self._counter_filename, 'w', encoding='utf-8') as outfile:
-                json.dump({
-                    'exposure_count': self._exposure_count,
-                    'exposure_reference': self._exposure_count_reference,
-                }, outfile)
+            # Save updated counts to disk without blocking the end of the sequence
+            with self._counter_condition:
+                self._counter_pending = (self._exposure_count, self._exposure_count_reference)
+                self._counter_condition.notify()
 
             # Wait for processing to complete
             while processing > 0:
@@ -282,6 +509,29 @@ class SDKInterface:
                 log.info(self._config.log_name, 'Exposure sequence complete')
             self._stop_acquisition = False
 
+    def __save_counters(self):
+        """Background thread that atomically replaces the persistent frame counter file with the latest counts"""
+        temp_filename = self._counter_filename + '.tmp'
+        while True:
+            with self._counter_condition:
+                self._counter_condition.wait_for(lambda: self._counter_pending is not None or self._counter_shutdown)
+                pending = self._counter_pending
+                self._counter_pending = None
+
+            if pending is None:
+                return
+
+            exposure_count, exposure_reference = pending
+            try:
+                with open(temp_filename, 'w', encoding='utf-8') as outfile:
+                    json.dump({
+                        'exposure_count': exposure_count,
+                        'exposure_reference': exposure_reference,
+                    }, outfile)
+                os.replace(temp_filename, self._counter_filename)
+            except Exception as e:
+                print('Failed to save frame counters with error', e)
+
     def set_cooling(self, enabled, quiet):
         """Set the camera cooler"""
         try:
@@ -305,25 +555,24 @@ class SDKInterface:
             if self._stop_acquisition:
                 state = CameraStatus.Aborting
             else:
-                if self._sequence_exposure_start_time is not None:
-                    exposure_progress = (Time.now() - self._sequence_exposure_start_time).to(u.s).value
+                if self._sequence_exposure_start_ns is not None:
+                    exposure_progress = (time.monotonic_ns() - self._sequence_exposure_start_ns) * 1e-9
                     if exposure_progress >= self._exposure_time:
                         state = CameraStatus.Reading
 
-        return {
-            'state': state,
-            'cooler_enabled': self._cooler_enabled,
-            'cooler_temperature': self._temperature,
-            'cooler_setpoint': float(self._config.temperature_setpoint),
-            'temperature_locked': self._temperature_locked,  # used by opsd
-            'exposure_time': self._exposure_time,
-            'exposure_progress': exposure_progress,
-            'window': self._window_region,
-            'binning': self._binning,
-            'read_mode': self._read_mode.upper(),
-            'sequence_frame_limit': self._sequence_frame_limit,
-            'sequence_frame_count': sequence_frame_count,
-        }
+        status = self._status
+        status['state'] = state
+        status['cooler_enabled'] = self._cooler_enabled
+        status['cooler_temperature'] = self._temperature
+        status['temperature_locked'] = self._temperature_locked  # used by opsd
+        status['exposure_time'] = self._exposure_time
+        status['exposure_progress'] = exposure_progress
+        status['window'] = self._window_region
+        status['binning'] = self._binning
+        status['read_mode'] = self._read_mode.upper()
+        status['sequence_frame_limit'] = self._sequence_frame_limit
+        status['sequence_frame_count'] = sequence_frame_count
+        return status
 
     def initialize(self):
         """Connects to the camera driver"""
@@ -360,26 +609,25 @@ class SDKInterface:
             self._readout_width = cam.SensorWidth
             self._readout_height = cam.SensorHeight
             self._temperature = cam.SensorTemperature
-            self._temperature_status = cam.TemperatureStatus
-            self._temperature_locked = self._temperature_status == 'Stabilised'
+            self.__update_temperature_status(cam.TemperatureStatus)
             self._cooler_enabled = cam.SensorCooling
             self._cam = cam
 
             # Regions are 0-indexed x1,x2,y1,2
             # These are converted to 1-indexed when writing fits headers
-            self._window_region = [
+            self._window_region = (
                 0,
                 self._readout_width - 1,
                 0,
                 self._readout_height - 1
-            ]
+            )
 
-            self._image_region = [
+            self._image_region = (
                 0,
                 self._readout_width - 1,
                 0,
                 self._readout_height - 1
-            ]
+            )
 
             log.info(self._config.log_name, 'Initialized camera')
             return CommandStatus.Succeeded
@@ -412,7 +660,7 @@ class SDKInterface:
         previous = format_window(self._window_region)
 
         if window is None:
-            self._window_region = [0, self._readout_width - 1, 0, self._readout_height - 1]
+            self._window_region = (0, self._readout_width - 1, 0, self._readout_height - 1)
 
         elif len(window) == 4:
             if window[0] < 1 or window[0] > self._readout_width:
@@ -425,7 +673,7 @@ class SDKInterface:
                 return CommandStatus.WindowOutsideSensor
 
             # Convert from 1-indexed to 0-indexed
-            self._window_region = [x - 1 for x in window]
+            self._window_region = tuple(x - 1 for x in window)
         else:
             return CommandStatus.Failed
 
@@ -485,6 +733,18 @@ class SDKInterface:
             self._stop_acquisition = True
             self._acquisition_thread.join()
 
+        print('shutdown: stopping status thread')
+        with self._status_condition:
+            self._status_shutdown = True
+            self._status_condition.notify_all()
+        self._status_thread.join()
+
+        print('shutdown: saving frame counters')
+        with self._counter_condition:
+            self._counter_shutdown = True
+            self._counter_condition.notify()
+        self._counter_thread.join()
+
         print('shutdown: disconnecting SDK')
         self._cam = None
 
@@ -535,47 +795,61 @@ class SDKInterface:
 
 
 def sdk_process(camd_pipe, config,
-                processing_queue, processing_framebuffer, processing_framebuffer_offsets,
+                processing_queue, processing_sequence_queues, processing_framebuffer, processing_framebuffer_offsets,
                 stop_signal):
-    cam = SDKInterface(config, processing_queue, processing_framebuffer, processing_framebuffer_offsets, stop_signal)
+    cam = SDKInterface(config, processing_queue, processing_sequence_queues,
+                       processing_framebuffer, processing_framebuffer_offsets, stop_signal)
     ret = cam.initialize()
 
-    camd_pipe.send(ret)
+    camd_pipe.send_bytes(encode_sdk_response(ret))
     if ret != CommandStatus.Succeeded:
         return
 
     try:
         while True:
-            if camd_pipe.poll(timeout=1):
+            # Block until camd sends a command (or closes its end of the pipe)
+            try:
                 c = camd_pipe.recv()
-                command = c['command']
-                args = c['args']
-
-                if command == 'cooling':
-                    camd_pipe.send(cam.set_cooling(args['enabled'], args['quiet']))
-                elif command == 'exposure':
-                    camd_pipe.send(cam.set_exposure(args['exposure'], args['quiet']))
-                elif command == 'window':
-                    camd_pipe.send(cam.set_window(args['window'], args['quiet']))
-                elif command == 'binning':
-                    camd_pipe.send(cam.set_binning(args['binning'], args['quiet']))
-                elif command == 'mode':
-                    camd_pipe.send(cam.set_readout_mode(args['mode'], args['quiet']))
-                elif command == 'start':
-                    camd_pipe.send(cam.start_sequence(args['count'], args['quiet']))
-                elif command == 'stop':
-                    camd_pipe.send(cam.stop_sequence(args['quiet']))
-                elif command == 'status':
-                    camd_pipe.send(cam.report_status())
-                elif command == 'shutdown':
-                    break
-                else:
-                    print(f'unhandled command: {command}')
-                    camd_pipe.send(CommandStatus.Failed)
+            except EOFError:
+                break
+
+            command = c['command']
+            args = c['args']
+
+            if command == 'cooling':
+                response = cam.set_cooling(args['enabled'], args['quiet'])
+            elif command == 'exposure':
+                response = cam.set_exposure(args['exposure'], args['quiet'])
+            elif command == 'window':
+                response = cam.set_window(args['window'], args['quiet'])
+            elif command == 'binning':
+                response = cam.set_binning(args['binning'], args['quiet'])
+            elif command == 'mode':
+                response = cam.set_readout_mode(args['mode'], args['quiet'])
+            elif command == 'start':
+                response = cam.start_sequence(args['count'], args['quiet'])
+            elif command == 'stop':
+                response = cam.stop_sequence(args['quiet'])
+            elif command == 'status':
+                response = cam.report_status()
+            elif command == 'shutdown':
+                break
+            else:
+                print(f'unhandled command: {command}')
+                response = CommandStatus.Failed
+
+            # A reply that can't be packed shouldn't take down the command loop
+            try:
+                data = encode_sdk_response(response)
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+                data = encode_sdk_response(CommandStatus.Failed)
+
+            camd_pipe.send_bytes(data)
 
     except Exception:
         traceback.print_exc(file=sys.stdout)
-        camd_pipe.send(CommandStatus.Failed)
+        camd_pipe.send_bytes(encode_sdk_response(CommandStatus.Failed))
 
     camd_pipe.close()
     cam.shutdown()